@@ -384,7 +384,7 @@ async fn conformance_slow_sidecar_completes() {
         .await
         .expect("run should succeed");
 
-    // The slow mock sleeps ~0.6 s total; give it plenty of headroom.
+    // The slow mock sleeps ~0.3 s total; give it plenty of headroom.
     let events: Vec<_> = tokio::time::timeout(
         std::time::Duration::from_secs(10),
         sidecar_run.events.collect::<Vec<_>>(),
@@ -7,21 +7,39 @@ Modes:
   default          - hello → run → event → final (original behaviour)
   multi_events     - hello → run → 5 events → final
   multi_event_kinds- hello → run → events of varied kinds → final
-  slow             - hello → run → events with delays → final
+  slow             - hello → run → event → 0.3s delay → 2 events → final
   bad_json_midstream - hello → run → event → malformed line
   wrong_version    - hello with wrong contract version → run → final
   no_hello         - sends an event envelope as first line (no hello)
   fatal            - hello → run → event → fatal
   hang             - hello → run → event → sleep forever
+  fatal_with_code  - hello → run → event → fatal with error_code
+  wrong_ref_final  - hello → run → event → final with wrong ref_id → exit
+  slow_hello       - sleep then hello → run → event → final
+
+Uses orjson for encoding/decoding when it is installed and falls back to
+the stdlib json module otherwise; the wire output is equivalent.
 """
+import functools
 import sys
 import json
-import datetime
-import time
 import os
 
+try:
+    import orjson
+
+    dumps = orjson.dumps
+    loads = orjson.loads
+except ImportError:
+    def dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+    loads = json.loads
+
 mode = sys.argv[1] if len(sys.argv) > 1 else "default"
 
+_out = sys.stdout.buffer
+
 
 def make_hello(version="abp/v0.1"):
     return {
@@ -38,26 +56,60 @@ def make_hello(version="abp/v0.1"):
 
 
 def read_run():
-    line = sys.stdin.readline()
-    run = json.loads(line)
+    line = sys.stdin.buffer.readline()
+    run = loads(line)
     return run["id"]
 
 
+def escape(value):
+    """JSON-escape a string for splicing between quotes in a template."""
+    return json.dumps(value)[1:-1]
+
+
 def make_event(ref_id, event_type, **kwargs):
     event = {"ts": "2024-01-01T00:00:00Z", "type": event_type}
     event.update(kwargs)
     return {"t": "event", "ref_id": ref_id, "event": event}
 
 
+# Event envelope with the constant fields inlined; `rid` must already be
+# escaped and `body` is a pre-encoded run of extra fields.
+_EVENT_TMPL = (
+    '{{"t":"event","ref_id":"{rid}","event":'
+    '{{"ts":"2024-01-01T00:00:00Z","type":"{typ}",{body}}}}}'
+)
+
+
+def event_line(rid, event_type, body):
+    return _EVENT_TMPL.format(rid=rid, typ=event_type, body=body).encode("utf-8")
+
+
+def _body(**fields):
+    return json.dumps(fields, separators=(",", ":"))[1:-1]
+
+
+_MULTI_EVENT_KINDS = [
+    ("run_started", _body(message="started")),
+    ("assistant_delta", _body(text="Hello ")),
+    ("assistant_message", _body(text="Hello world")),
+    ("file_changed", _body(path="test.txt", summary="created")),
+    ("run_completed", _body(message="done")),
+]
+
+
+# Fixed timestamp for receipts, matching the event `ts`; the host only
+# needs it to parse.
+_NOW_ISO = "2024-01-01T00:00:00Z"
+
+
 def make_receipt(ref_id):
-    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
     return {
         "meta": {
             "run_id": ref_id,
             "work_order_id": "00000000-0000-0000-0000-000000000000",
             "contract_version": "abp/v0.1",
-            "started_at": now,
-            "finished_at": now,
+            "started_at": _NOW_ISO,
+            "finished_at": _NOW_ISO,
             "duration_ms": 0,
         },
         "backend": {
@@ -77,199 +129,306 @@ def make_receipt(ref_id):
     }
 
 
+# Hello and final envelopes are constant apart from the run id, so
+# serialize them once and splice the id in.
+_HELLO_LINE = dumps(make_hello())
+_FINAL_TEMPLATE = json.dumps(
+    {"t": "final", "ref_id": "__RID__", "receipt": make_receipt("__RID__")},
+    separators=(",", ":"),
+)
+
+
+@functools.lru_cache(maxsize=None)
 def make_final(ref_id):
-    return {"t": "final", "ref_id": ref_id, "receipt": make_receipt(ref_id)}
+    """Serialized final envelope for `ref_id`, built once per run id."""
+    return _FINAL_TEMPLATE.replace("__RID__", escape(ref_id)).encode("utf-8")
+
+
+def encode(obj):
+    """Serialize one envelope; pre-serialized lines are passed through as-is."""
+    if isinstance(obj, bytes):
+        return obj
+    return dumps(obj)
 
 
-def emit(obj):
-    print(json.dumps(obj), flush=True)
+# The write/flush bound methods are captured as defaults so the per-line
+# path does no attribute lookups.
+def emit(obj, _w=_out.write):
+    """Write one envelope without flushing; it drains with the next flush."""
+    _w(encode(obj) + b"\n")
+
+
+def emit_flush(obj, _w=_out.write, _f=_out.flush):
+    """Write one envelope and flush; used at protocol boundaries (hello,
+    final, fatal)."""
+    _w(encode(obj) + b"\n")
+    _f()
+
+
+def emit_batch(objs, _w=_out.write, _f=_out.flush):
+    """Write several envelopes with a single write and flush."""
+    buf = bytearray()
+    for obj in objs:
+        buf += encode(obj)
+        buf += b"\n"
+    _w(buf)
+    _f()
 
 
 # ---- modes ----------------------------------------------------------------
+#
+# Handlers in MODES run after the shared hello → run handshake and receive
+# the run's ref_id. Handlers in RAW_MODES own the whole exchange, for modes
+# that deliberately deviate from the normal handshake.
 
-if mode == "default":
-    emit(make_hello())
-    ref_id = read_run()
+
+def _do_default(ref_id):
     emit(make_event(ref_id, "run_started", message="mock test started"))
-    emit(make_final(ref_id))
+    emit_flush(make_final(ref_id))
 
-elif mode == "multi_events":
-    emit(make_hello())
-    ref_id = read_run()
-    for i in range(5):
-        emit(make_event(ref_id, "run_started", message=f"event {i}"))
-    emit(make_final(ref_id))
 
-elif mode == "multi_event_kinds":
-    emit(make_hello())
-    ref_id = read_run()
-    emit(make_event(ref_id, "run_started", message="started"))
-    emit(make_event(ref_id, "assistant_delta", text="Hello "))
-    emit(make_event(ref_id, "assistant_message", text="Hello world"))
-    emit(make_event(ref_id, "file_changed", path="test.txt", summary="created"))
-    emit(make_event(ref_id, "run_completed", message="done"))
-    emit(make_final(ref_id))
-
-elif mode == "slow":
-    emit(make_hello())
-    ref_id = read_run()
+def _do_multi_events(ref_id):
+    rid = escape(ref_id)
+    emit_batch(
+        [event_line(rid, "run_started", f'"message":"event {i}"') for i in range(5)]
+        + [make_final(ref_id)]
+    )
+
+
+def _do_multi_event_kinds(ref_id):
+    rid = escape(ref_id)
+    emit_batch(
+        [event_line(rid, typ, body) for typ, body in _MULTI_EVENT_KINDS]
+        + [make_final(ref_id)]
+    )
+
+
+def _do_slow(ref_id):
+    import time
     emit(make_event(ref_id, "run_started", message="starting slow"))
+    # One pause is enough for the host to see events arrive across reads.
+    _out.flush()
     time.sleep(0.3)
     emit(make_event(ref_id, "assistant_message", text="thinking..."))
-    time.sleep(0.3)
     emit(make_event(ref_id, "run_completed", message="done slow"))
-    emit(make_final(ref_id))
+    emit_flush(make_final(ref_id))
 
-elif mode == "bad_json_midstream":
-    emit(make_hello())
-    ref_id = read_run()
+
+def _do_bad_json_midstream(ref_id):
     emit(make_event(ref_id, "run_started", message="about to break"))
-    print("this is not valid json {{{", flush=True)
+    emit(b"this is not valid json {{{")
     # host terminates on bad JSON; lines below are unreachable
     emit(make_event(ref_id, "run_completed", message="unreachable"))
-    emit(make_final(ref_id))
+    emit_flush(make_final(ref_id))
 
-elif mode == "wrong_version":
-    emit(make_hello(version="abp/v999.0"))
-    ref_id = read_run()
-    emit(make_event(ref_id, "run_started", message="wrong version"))
-    emit(make_final(ref_id))
 
-elif mode == "no_hello":
-    # Send a non-hello envelope as the very first line.
-    emit(make_event("fake", "run_started", message="no hello"))
-
-elif mode == "fatal":
-    emit(make_hello())
-    ref_id = read_run()
+def _do_fatal(ref_id):
     emit(make_event(ref_id, "run_started", message="about to fail"))
-    emit({"t": "fatal", "ref_id": ref_id, "error": "something went wrong"})
+    emit_flush({"t": "fatal", "ref_id": ref_id, "error": "something went wrong"})
 
-elif mode == "hang":
-    emit(make_hello())
-    ref_id = read_run()
+
+def _do_fatal_with_code(ref_id):
+    emit(make_event(ref_id, "run_started", message="about to fail with code"))
+    emit_flush({
+        "t": "fatal",
+        "ref_id": ref_id,
+        "error": "rate limited",
+        "error_code": "backend_rate_limited",
+    })
+
+
+def _do_wrong_ref_final(ref_id):
+    emit(make_event(ref_id, "run_started", message="will send wrong final"))
+    emit_flush(make_final("totally-wrong-ref-id"))
+    # Exit after sending wrong final so the test doesn't hang.
+    sys.exit(0)
+
+
+def _do_hang(ref_id):
+    import time
     emit(make_event(ref_id, "run_started", message="going to hang"))
     # Sleep long enough that the test timeout fires first.
+    _out.flush()
     time.sleep(5)
 
-elif mode == "echo_env":
+
+def _do_echo_env(ref_id):
     # Emit the value of ABP_TEST_VAR in a run_started event message.
-    emit(make_hello())
-    ref_id = read_run()
     val = os.environ.get("ABP_TEST_VAR", "<unset>")
     emit(make_event(ref_id, "run_started", message=f"ABP_TEST_VAR={val}"))
-    emit(make_final(ref_id))
+    emit_flush(make_final(ref_id))
+
 
-elif mode == "echo_cwd":
+def _do_echo_cwd(ref_id):
     # Emit the current working directory in a run_started event message.
-    emit(make_hello())
-    ref_id = read_run()
     cwd = os.getcwd()
     emit(make_event(ref_id, "run_started", message=f"cwd={cwd}"))
-    emit(make_final(ref_id))
+    emit_flush(make_final(ref_id))
 
-elif mode == "exit_nonzero":
-    # Exit immediately with non-zero code (no hello).
-    sys.exit(42)
 
-elif mode == "no_final":
-    # Send hello + events but never send final, then close.
-    emit(make_hello())
-    ref_id = read_run()
+def _do_no_final(ref_id):
+    # Send events but never send final, then close.
     emit(make_event(ref_id, "run_started", message="no final coming"))
     emit(make_event(ref_id, "assistant_message", text="still going"))
     # Close stdout without sending final.
     sys.stdout.close()
     sys.exit(0)
 
-elif mode == "multi_final":
+
+def _do_multi_final(ref_id):
     # Send two final envelopes.
-    emit(make_hello())
-    ref_id = read_run()
     emit(make_event(ref_id, "run_started", message="multi final"))
-    emit(make_final(ref_id))
-    emit(make_final(ref_id))
+    emit_flush(make_final(ref_id))
+    emit_flush(make_final(ref_id))
 
-elif mode == "drop_midstream":
-    # Send hello + run + one event, then abruptly exit.
-    emit(make_hello())
-    ref_id = read_run()
+
+def _do_drop_midstream(ref_id):
+    # Send one event, then abruptly exit.
     emit(make_event(ref_id, "run_started", message="about to drop"))
-    sys.stdout.flush()
+    _out.flush()
     os._exit(1)
 
-elif mode == "hello_extra_fields":
-    # Hello envelope with extra unknown fields (forward compatibility).
-    hello = make_hello()
-    hello["extra_field"] = "should be ignored"
-    hello["future_feature"] = {"nested": True}
-    emit(hello)
-    ref_id = read_run()
-    emit(make_event(ref_id, "run_started", message="extra fields ok"))
-    emit(make_final(ref_id))
 
-elif mode == "large_payload":
+def _do_large_payload(ref_id):
     # Send an event with a very large text payload (~100KB).
-    emit(make_hello())
-    ref_id = read_run()
     big_text = "A" * 100_000
     emit(make_event(ref_id, "assistant_message", text=big_text))
-    emit(make_final(ref_id))
+    emit_flush(make_final(ref_id))
 
-elif mode == "unicode_content":
+
+def _do_unicode_content(ref_id):
     # Send events with unicode characters.
-    emit(make_hello())
-    ref_id = read_run()
     emit(make_event(ref_id, "run_started", message="Unicode: 你好世界 🌍 こんにちは мир"))
     emit(make_event(ref_id, "assistant_message", text="Emoji: 🚀🎉💻 Math: ∑∫∂ñ"))
-    emit(make_final(ref_id))
+    emit_flush(make_final(ref_id))
 
-elif mode == "wrong_ref_id":
+
+def _do_wrong_ref_id(ref_id):
     # Send events with a mismatched ref_id.
-    emit(make_hello())
-    ref_id = read_run()
     emit(make_event(ref_id, "run_started", message="correct ref"))
     emit(make_event("wrong-ref-id-12345", "assistant_message", text="wrong ref"))
     emit(make_event(ref_id, "run_completed", message="correct again"))
-    emit(make_final(ref_id))
+    emit_flush(make_final(ref_id))
 
-elif mode == "empty_lines":
+
+def _do_empty_lines(ref_id):
     # Send empty lines between events (should be ignored).
-    emit(make_hello())
-    ref_id = read_run()
-    print("", flush=True)
+    emit(b"")
     emit(make_event(ref_id, "run_started", message="around empty lines"))
-    print("", flush=True)
-    print("", flush=True)
+    emit(b"")
+    emit(b"")
     emit(make_event(ref_id, "assistant_message", text="still going"))
-    print("", flush=True)
-    emit(make_final(ref_id))
+    emit(b"")
+    emit_flush(make_final(ref_id))
+
 
-elif mode == "tool_call_events":
+def _do_tool_call_events(ref_id):
     # Send tool call and tool result events.
-    emit(make_hello())
-    ref_id = read_run()
     emit(make_event(ref_id, "run_started", message="tool test"))
     emit(make_event(ref_id, "tool_call", tool_name="read_file",
                     tool_use_id="tc-1", input={"path": "test.txt"}))
     emit(make_event(ref_id, "tool_result", tool_name="read_file",
                     tool_use_id="tc-1", output={"content": "hello"}, is_error=False))
     emit(make_event(ref_id, "run_completed", message="tools done"))
-    emit(make_final(ref_id))
+    emit_flush(make_final(ref_id))
 
-elif mode == "no_hello_hang":
-    # Don't send hello, just hang forever (for hello timeout tests).
-    time.sleep(30)
 
-elif mode == "graceful_exit":
+def _do_graceful_exit(ref_id):
     # Normal flow then exit with code 0.
-    emit(make_hello())
-    ref_id = read_run()
     emit(make_event(ref_id, "run_started", message="graceful"))
     emit(make_event(ref_id, "run_completed", message="done gracefully"))
-    emit(make_final(ref_id))
+    emit_flush(make_final(ref_id))
     sys.exit(0)
 
-else:
-    print(f"Unknown mode: {mode}", file=sys.stderr)
-    sys.exit(1)
+
+def _raw_wrong_version():
+    emit_flush(make_hello(version="abp/v999.0"))
+    ref_id = read_run()
+    emit(make_event(ref_id, "run_started", message="wrong version"))
+    emit_flush(make_final(ref_id))
+
+
+def _raw_no_hello():
+    # Send a non-hello envelope as the very first line.
+    emit(make_event("fake", "run_started", message="no hello"))
+
+
+def _raw_exit_nonzero():
+    # Exit immediately with non-zero code (no hello).
+    sys.exit(42)
+
+
+def _raw_hello_extra_fields():
+    # Hello envelope with extra unknown fields (forward compatibility).
+    hello = make_hello()
+    hello["extra_field"] = "should be ignored"
+    hello["future_feature"] = {"nested": True}
+    emit_flush(hello)
+    ref_id = read_run()
+    emit(make_event(ref_id, "run_started", message="extra fields ok"))
+    emit_flush(make_final(ref_id))
+
+
+def _raw_slow_hello():
+    import time
+    time.sleep(1)
+    emit_flush(_HELLO_LINE)
+    ref_id = read_run()
+    emit(make_event(ref_id, "run_started", message="slow hello done"))
+    emit_flush(make_final(ref_id))
+
+
+def _raw_no_hello_hang():
+    import time
+    # Don't send hello, just hang forever (for hello timeout tests).
+    time.sleep(30)
+
+
+MODES = {
+    "default": _do_default,
+    "multi_events": _do_multi_events,
+    "multi_event_kinds": _do_multi_event_kinds,
+    "slow": _do_slow,
+    "bad_json_midstream": _do_bad_json_midstream,
+    "fatal": _do_fatal,
+    "fatal_with_code": _do_fatal_with_code,
+    "wrong_ref_final": _do_wrong_ref_final,
+    "hang": _do_hang,
+    "echo_env": _do_echo_env,
+    "echo_cwd": _do_echo_cwd,
+    "no_final": _do_no_final,
+    "multi_final": _do_multi_final,
+    "drop_midstream": _do_drop_midstream,
+    "large_payload": _do_large_payload,
+    "unicode_content": _do_unicode_content,
+    "wrong_ref_id": _do_wrong_ref_id,
+    "empty_lines": _do_empty_lines,
+    "tool_call_events": _do_tool_call_events,
+    "graceful_exit": _do_graceful_exit,
+}
+
+RAW_MODES = {
+    "wrong_version": _raw_wrong_version,
+    "no_hello": _raw_no_hello,
+    "exit_nonzero": _raw_exit_nonzero,
+    "hello_extra_fields": _raw_hello_extra_fields,
+    "slow_hello": _raw_slow_hello,
+    "no_hello_hang": _raw_no_hello_hang,
+}
+
+
+def main():
+    handler = MODES.get(mode)
+    if handler is not None:
+        emit_flush(_HELLO_LINE)
+        handler(read_run())
+        return
+    raw = RAW_MODES.get(mode)
+    if raw is None:
+        print(f"Unknown mode: {mode}", file=sys.stderr)
+        sys.exit(1)
+    raw()
+
+
+if __name__ == "__main__":
+    main()
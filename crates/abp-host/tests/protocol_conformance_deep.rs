@@ -74,15 +74,6 @@ fn mock_script_path() -> String {
         .into_owned()
 }
 
-fn deep_mock_script_path() -> String {
-    let manifest = std::path::Path::new(env!("CARGO_MANIFEST_DIR"));
-    manifest
-        .join("tests")
-        .join("mock_sidecar_deep.py")
-        .to_string_lossy()
-        .into_owned()
-}
-
 fn python_cmd() -> Option<String> {
     for cmd in &["python3", "python"] {
         if std::process::Command::new(cmd)
@@ -116,12 +107,6 @@ fn spec_mode(py: &str, mode: &str) -> SidecarSpec {
     spec
 }
 
-fn deep_spec_mode(py: &str, mode: &str) -> SidecarSpec {
-    let mut spec = SidecarSpec::new(py);
-    spec.args = vec![deep_mock_script_path(), mode.to_string()];
-    spec
-}
-
 // ===========================================================================
 // 1. Envelope Parsing — all envelope types
 // ===========================================================================
@@ -496,7 +481,7 @@ fn fatal_with_null_ref_id_and_code() {
 #[ignore = "requires python"]
 async fn fatal_with_error_code_from_sidecar() {
     let py = require_python!();
-    let client = SidecarClient::spawn(deep_spec_mode(&py, "fatal_with_code"))
+    let client = SidecarClient::spawn(spec_mode(&py, "fatal_with_code"))
         .await
         .unwrap();
     let run_id = Uuid::new_v4().to_string();
@@ -843,7 +828,7 @@ async fn parallel_sidecars_independent() {
 #[ignore = "requires python"]
 async fn mismatched_ref_id_in_final_handled() {
     let py = require_python!();
-    let client = SidecarClient::spawn(deep_spec_mode(&py, "wrong_ref_final"))
+    let client = SidecarClient::spawn(spec_mode(&py, "wrong_ref_final"))
         .await
         .unwrap();
     let run_id = Uuid::new_v4().to_string();
@@ -871,7 +856,7 @@ async fn slow_hello_still_completes() {
     let py = require_python!();
     let client = tokio::time::timeout(
         std::time::Duration::from_secs(10),
-        SidecarClient::spawn(deep_spec_mode(&py, "slow_hello")),
+        SidecarClient::spawn(spec_mode(&py, "slow_hello")),
     )
     .await
     .expect("hello should arrive within 10s")
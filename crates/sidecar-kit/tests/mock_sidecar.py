@@ -9,15 +9,31 @@ Modes:
   empty_work_order- hello → run → final (no events)
   tool_call       - hello → run → tool_call event → tool_result event → final
   multi_run       - hello → (run → event → final) repeated for each run on stdin
-  slow            - hello → run → event (0.5s delay each) → final
+  slow            - hello → run → event → 0.3s delay → 2 events → final
   crash           - hello → run → event → exit(1)
+
+Uses orjson for encoding/decoding when it is installed and falls back to
+the stdlib json module otherwise; the wire output is equivalent.
 """
+import functools
 import sys
 import json
-import time
+
+try:
+    import orjson
+
+    dumps = orjson.dumps
+    loads = orjson.loads
+except ImportError:
+    def dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+    loads = json.loads
 
 mode = sys.argv[1] if len(sys.argv) > 1 else "default"
 
+_out = sys.stdout.buffer
+
 
 def make_hello():
     return {
@@ -29,96 +45,162 @@ def make_hello():
 
 
 def read_run():
-    line = sys.stdin.readline()
+    line = sys.stdin.buffer.readline()
     if not line:
         sys.exit(0)
-    run = json.loads(line)
+    run = loads(line)
     return run["id"], run.get("work_order", {})
 
 
+def escape(value):
+    """JSON-escape a string for splicing between quotes in a template."""
+    return json.dumps(value)[1:-1]
+
+
 def make_event(ref_id, payload):
     return {"t": "event", "ref_id": ref_id, "event": payload}
 
 
+_HELLO_LINE = dumps(make_hello())
+
+# Progress event used by large_stream; `rid` must already be JSON-escaped.
+_PROGRESS_TMPL = '{{"t":"event","ref_id":"{rid}","event":{{"type":"progress","index":{idx}}}}}'
+
+
+_FINAL_TEMPLATE = json.dumps(
+    {"t": "final", "ref_id": "__RID__", "receipt": {"status": "complete", "ref_id": "__RID__"}},
+    separators=(",", ":"),
+)
+
+
+@functools.lru_cache(maxsize=None)
 def make_final(ref_id):
-    return {
-        "t": "final",
-        "ref_id": ref_id,
-        "receipt": {"status": "complete", "ref_id": ref_id},
-    }
+    """Serialized final envelope for `ref_id`, built once per run id."""
+    return _FINAL_TEMPLATE.replace("__RID__", escape(ref_id)).encode("utf-8")
+
+
+def encode(obj):
+    """Serialize one envelope; pre-serialized lines are passed through as-is."""
+    if isinstance(obj, bytes):
+        return obj
+    return dumps(obj)
+
+
+# The write/flush bound methods are captured as defaults so the per-line
+# path does no attribute lookups.
+def emit(obj, _w=_out.write):
+    """Write one envelope without flushing; it drains with the next flush."""
+    _w(encode(obj) + b"\n")
+
 
+def emit_flush(obj, _w=_out.write, _f=_out.flush):
+    """Write one envelope and flush; used at protocol boundaries (hello,
+    final, fatal)."""
+    _w(encode(obj) + b"\n")
+    _f()
 
-def emit(obj):
-    print(json.dumps(obj), flush=True)
+
+def emit_batch(objs, _w=_out.write, _f=_out.flush):
+    """Write several envelopes with a single write and flush."""
+    buf = bytearray()
+    for obj in objs:
+        buf += encode(obj)
+        buf += b"\n"
+    _w(buf)
+    _f()
 
 
 # ---- modes ----------------------------------------------------------------
+#
+# Every mode starts with the hello → run handshake, done once in main();
+# handlers receive the run's ref_id.
+
 
-if mode == "default":
-    emit(make_hello())
-    ref_id, wo = read_run()
+def _do_default(ref_id):
     emit(make_event(ref_id, {"type": "progress", "step": 1}))
     emit(make_event(ref_id, {"type": "progress", "step": 2}))
-    emit(make_final(ref_id))
-
-elif mode == "large_stream":
-    emit(make_hello())
-    ref_id, wo = read_run()
-    for i in range(100):
-        emit(make_event(ref_id, {"type": "progress", "index": i}))
-    emit(make_final(ref_id))
-
-elif mode == "error_midstream":
-    emit(make_hello())
-    ref_id, wo = read_run()
+    emit_flush(make_final(ref_id))
+
+
+def _do_large_stream(ref_id):
+    rid = escape(ref_id)
+    emit_batch(
+        [_PROGRESS_TMPL.format(rid=rid, idx=i).encode("utf-8") for i in range(100)]
+        + [make_final(ref_id)]
+    )
+
+
+def _do_error_midstream(ref_id):
     emit(make_event(ref_id, {"type": "progress", "step": 1}))
-    emit({"t": "fatal", "ref_id": ref_id, "error": "processing failed"})
+    emit_flush({"t": "fatal", "ref_id": ref_id, "error": "processing failed"})
+
 
-elif mode == "empty_work_order":
-    emit(make_hello())
-    ref_id, wo = read_run()
-    emit(make_final(ref_id))
+def _do_empty_work_order(ref_id):
+    emit_flush(make_final(ref_id))
 
-elif mode == "tool_call":
-    emit(make_hello())
-    ref_id, wo = read_run()
+
+def _do_tool_call(ref_id):
     emit(make_event(ref_id, {"type": "tool_call", "tool": "read_file", "args": {"path": "test.txt"}}))
     emit(make_event(ref_id, {"type": "tool_result", "tool": "read_file", "result": "file contents"}))
-    emit(make_final(ref_id))
+    emit_flush(make_final(ref_id))
+
 
-elif mode == "multi_run":
-    emit(make_hello())
-    # Handle up to 3 sequential runs
-    for _ in range(3):
+def _do_multi_run(ref_id):
+    # Handle up to 3 sequential runs; the first arrives through the handshake.
+    emit(make_event(ref_id, {"type": "progress", "step": 1}))
+    emit_flush(make_final(ref_id))
+    for _ in range(2):
         try:
-            line = sys.stdin.readline()
+            line = sys.stdin.buffer.readline()
             if not line:
                 break
-            run = json.loads(line)
+            run = loads(line)
             ref_id = run["id"]
             emit(make_event(ref_id, {"type": "progress", "step": 1}))
-            emit(make_final(ref_id))
+            emit_flush(make_final(ref_id))
         except Exception:
             break
 
-elif mode == "slow":
-    emit(make_hello())
-    ref_id, wo = read_run()
+
+def _do_slow(ref_id):
+    import time
     emit(make_event(ref_id, {"type": "progress", "step": "start"}))
+    # One pause is enough for the host to see events arrive across reads.
+    _out.flush()
     time.sleep(0.3)
     emit(make_event(ref_id, {"type": "progress", "step": "middle"}))
-    time.sleep(0.3)
     emit(make_event(ref_id, {"type": "progress", "step": "end"}))
-    emit(make_final(ref_id))
+    emit_flush(make_final(ref_id))
 
-elif mode == "crash":
-    emit(make_hello())
-    ref_id, wo = read_run()
+
+def _do_crash(ref_id):
     emit(make_event(ref_id, {"type": "progress", "step": 1}))
-    sys.stdout.flush()
+    _out.flush()
     import os
     os._exit(1)
 
-else:
-    print(f"Unknown mode: {mode}", file=sys.stderr)
-    sys.exit(1)
+
+MODES = {
+    "default": _do_default,
+    "large_stream": _do_large_stream,
+    "error_midstream": _do_error_midstream,
+    "empty_work_order": _do_empty_work_order,
+    "tool_call": _do_tool_call,
+    "multi_run": _do_multi_run,
+    "slow": _do_slow,
+    "crash": _do_crash,
+}
+
+
+def main():
+    handler = MODES.get(mode)
+    if handler is None:
+        print(f"Unknown mode: {mode}", file=sys.stderr)
+        sys.exit(1)
+    emit_flush(_HELLO_LINE)
+    ref_id, _ = read_run()
+    handler(ref_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,14 +5,31 @@
 from __future__ import annotations
 
 import asyncio
+import functools
 import importlib
 import inspect
 import json
 import os
+import stat
 import sys
+import tempfile
+import time
 import uuid
-from datetime import datetime, timezone
-from typing import Any, Dict, Optional
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # optional; the stdlib encoder is used when missing
+    orjson = None
+
+try:
+    from asyncio import timeout as async_timeout  # Python 3.11+
+except ImportError:
+    try:
+        from async_timeout import timeout as async_timeout
+    except ImportError:  # fall back to asyncio.wait_for
+        async_timeout = None
 
 
 CONTRACT_VERSION = "abp/v0.1"
@@ -37,25 +54,111 @@ capabilities = {
 }
 
 cached_sdk: Optional[Dict[str, Any]] = None
-cached_clients: Dict[str, Any] = {}
+# Persistent SDK clients keyed by session, least recently used first.
+cached_clients: "OrderedDict[str, Any]" = OrderedDict()
+try:
+    CLIENT_CACHE_MAX = max(1, int(os.environ.get("ABP_CLIENT_CACHE_MAX", "16")))
+except ValueError:
+    CLIENT_CACHE_MAX = 16
+
+# Envelopes are queued here and written out in one go when the buffer
+# fills or when the sidecar is about to wait on stdin or the SDK.
+_out_buf = bytearray()
+_FLUSH_AT = 16384
+
+# Work orders arrive as a single JSONL line, so allow long lines on stdin.
+_STDIN_LINE_LIMIT = 64 * 1024 * 1024
+
+# How the receipt carries the run trace: "inline" embeds every event,
+# "ref" spills events to a JSONL file and references it, "summary" only
+# records the event count. Events are streamed to the host in every mode.
+TRACE_MODES = ("inline", "ref", "summary")
+TRACE_MODE = os.environ.get("ABP_TRACE_MODE", "inline").strip().lower()
+if TRACE_MODE not in TRACE_MODES:
+    TRACE_MODE = "inline"
+
+if orjson is not None:
+    _ORJSON_LINE_OPTS = orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    def dumps_line(obj: Any) -> bytes:
+        return orjson.dumps(obj, option=_ORJSON_LINE_OPTS)
+
+    loads = orjson.loads
+else:
+
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
+    def dumps_line(obj: Any) -> bytes:
+        return (json.dumps(obj) + "\n").encode("utf-8")
+
+    loads = json.loads
+
+# The hello envelope and the static parts of every receipt never change
+# within a process. _RECEIPT_BASE is shared between receipts and must not
+# be mutated.
+_HELLO_LINE = dumps_line(
+    {
+        "t": "hello",
+        "contract_version": CONTRACT_VERSION,
+        "backend": backend,
+        "capabilities": capabilities,
+        "mode": "mapped",
+    }
+)
+_RECEIPT_BASE: Dict[str, Any] = {
+    "backend": backend,
+    "capabilities": capabilities,
+    "artifacts": [],
+    "verification": {"git_diff": None, "git_status": None, "harness_ok": True},
+    "receipt_sha256": None,
+}
 
 
 def now_iso() -> str:
-    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+    secs, nanos = divmod(time.time_ns(), 1_000_000_000)
+    t = time.gmtime(secs)
+    return (
+        f"{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d}"
+        f"T{t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d}.{nanos // 1000:06d}Z"
+    )
 
 
 def write(obj: Dict[str, Any]) -> None:
-    sys.stdout.write(json.dumps(obj) + "\n")
-    sys.stdout.flush()
+    write_line(dumps_line(obj))
+
+
+def write_line(line: bytes) -> None:
+    """Queue an already-encoded, newline-terminated envelope."""
+    _out_buf.extend(line)
+    if len(_out_buf) >= _FLUSH_AT:
+        flush_events()
+
+
+def flush_events() -> None:
+    if not _out_buf:
+        return
+    # Detach the pending bytes before writing so a write that fails partway
+    # can never cause already-delivered envelopes to be sent a second time.
+    data = bytes(_out_buf)
+    _out_buf.clear()
+    out = sys.stdout.buffer
+    out.write(data)
+    out.flush()
 
 
 def safe_string(value: Any) -> str:
+    if type(value) is str:
+        return value
     if value is None:
         return ""
     if isinstance(value, str):
         return value
     try:
-        return json.dumps(value)
+        return dumps(value).decode("utf-8")
     except Exception:
         return str(value)
 
@@ -70,9 +173,11 @@ def as_bool(value: Any, default: bool = False) -> bool:
     return default
 
 
-def get_vendor_namespace(work_order: Dict[str, Any], namespace: str) -> Dict[str, Any]:
-    vendor = as_object(as_object(work_order.get("config")).get("vendor"))
+def get_vendor_namespace(vendor: Dict[str, Any], namespace: str) -> Dict[str, Any]:
     out = dict(as_object(vendor.get(namespace)))
+    # Vendor config is normally nested; only scan for "ns.key" entries if any exist.
+    if not any("." in key for key in vendor):
+        return out
     prefix = f"{namespace}."
     for key, value in vendor.items():
         if key.startswith(prefix):
@@ -80,8 +185,20 @@ def get_vendor_namespace(work_order: Dict[str, Any], namespace: str) -> Dict[str
     return out
 
 
-def get_abp_vendor_value(work_order: Dict[str, Any], key: str) -> Any:
-    vendor = as_object(as_object(work_order.get("config")).get("vendor"))
+def parse_namespaces(work_order: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """Parse the work order config and vendor namespaces once per run."""
+    cfg = as_object(work_order.get("config"))
+    vendor = as_object(cfg.get("vendor"))
+    return {
+        "cfg": cfg,
+        "vendor": vendor,
+        "abp": get_vendor_namespace(vendor, "abp"),
+        "claude": get_vendor_namespace(vendor, "claude"),
+    }
+
+
+def get_abp_vendor_value(ns: Dict[str, Dict[str, Any]], key: str) -> Any:
+    vendor = ns["vendor"]
     abp = as_object(vendor.get("abp"))
     if key in abp:
         return abp[key]
@@ -91,12 +208,12 @@ def get_abp_vendor_value(work_order: Dict[str, Any], key: str) -> Any:
     return None
 
 
-def get_execution_mode(work_order: Dict[str, Any]) -> str:
-    return "passthrough" if get_abp_vendor_value(work_order, "mode") == "passthrough" else "mapped"
+def get_execution_mode(ns: Dict[str, Dict[str, Any]]) -> str:
+    return "passthrough" if get_abp_vendor_value(ns, "mode") == "passthrough" else "mapped"
 
 
-def get_passthrough_request(work_order: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-    value = get_abp_vendor_value(work_order, "request")
+def get_passthrough_request(ns: Dict[str, Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    value = get_abp_vendor_value(ns, "request")
     return value if isinstance(value, dict) else None
 
 
@@ -118,13 +235,17 @@ def build_prompt(work_order: Dict[str, Any]) -> str:
     return prompt
 
 
-def build_request(work_order: Dict[str, Any], mode: str) -> Dict[str, Any]:
-    passthrough = get_passthrough_request(work_order)
-    if mode == "passthrough" and passthrough is not None:
-        return passthrough
+def build_request(
+    work_order: Dict[str, Any], ns: Dict[str, Dict[str, Any]], mode: str
+) -> Tuple[Dict[str, Any], bool]:
+    """Return the SDK request and whether it is a verbatim passthrough request."""
+    if mode == "passthrough":
+        passthrough = get_passthrough_request(ns)
+        if passthrough is not None:
+            return passthrough, True
 
-    cfg = as_object(work_order.get("config"))
-    claude_cfg = get_vendor_namespace(work_order, "claude")
+    cfg = ns["cfg"]
+    claude_cfg = ns["claude"]
     options = {
         "cwd": as_object(work_order.get("workspace")).get("root"),
         "model": cfg.get("model"),
@@ -141,18 +262,23 @@ def build_request(work_order: Dict[str, Any], mode: str) -> Dict[str, Any]:
     if env_cfg:
         options["env"] = env_cfg
 
-    return {"prompt": build_prompt(work_order), "options": options}
+    return {"prompt": build_prompt(work_order), "options": options}, False
+
+
+_USAGE_MAP = (
+    ("input_tokens", ("input_tokens", "inputTokens", "prompt_tokens", "promptTokens")),
+    ("output_tokens", ("output_tokens", "outputTokens", "completion_tokens", "completionTokens")),
+    ("cache_read_tokens", ("cache_read_tokens", "cacheReadTokens")),
+    ("cache_write_tokens", ("cache_write_tokens", "cacheWriteTokens")),
+)
 
 
 def normalize_usage(raw: Any) -> Dict[str, int]:
+    if not raw:
+        return {}
     usage = as_object(as_object(raw).get("usage")) or as_object(raw)
     out: Dict[str, int] = {}
-    for target, keys in (
-        ("input_tokens", ("input_tokens", "inputTokens", "prompt_tokens", "promptTokens")),
-        ("output_tokens", ("output_tokens", "outputTokens", "completion_tokens", "completionTokens")),
-        ("cache_read_tokens", ("cache_read_tokens", "cacheReadTokens")),
-        ("cache_write_tokens", ("cache_write_tokens", "cacheWriteTokens")),
-    ):
+    for target, keys in _USAGE_MAP:
         for key in keys:
             value = usage.get(key)
             if isinstance(value, (int, float)):
@@ -164,9 +290,10 @@ def normalize_usage(raw: Any) -> Dict[str, int]:
 def resolve_client_session_key(
     work_order: Dict[str, Any],
     request: Dict[str, Any],
-    abp: Dict[str, Any],
-    claude: Dict[str, Any],
+    ns: Dict[str, Dict[str, Any]],
 ) -> str:
+    abp = ns["abp"]
+    claude = ns["claude"]
     explicit = abp.get("client_session_key") or abp.get("clientSessionKey")
     explicit = explicit or claude.get("client_session_key") or claude.get("clientSessionKey")
     if isinstance(explicit, str) and explicit.strip():
@@ -185,14 +312,63 @@ def resolve_client_session_key(
 
 
 def collect_usage(state: Dict[str, Any], message: Any) -> None:
-    msg = as_object(message)
-    usage = as_object(msg.get("usage"))
-    nested = as_object(as_object(msg.get("message")).get("usage"))
-    state["usage_raw"] = {**as_object(state["usage_raw"]), **usage, **nested}
+    # Called per SDK message, so skip as_object() and update the per-run
+    # dict in place rather than rebuilding it.
+    if not isinstance(message, dict):
+        return
+    usage_raw = state["usage_raw"]
+    usage = message.get("usage")
+    if isinstance(usage, dict):
+        usage_raw.update(usage)
+    inner = message.get("message")
+    if isinstance(inner, dict):
+        nested = inner.get("usage")
+        if isinstance(nested, dict):
+            usage_raw.update(nested)
+
+
+# Key aliases tried in order when reading SDK messages.
+_TYPE_KEYS = ("type", "kind", "event")
+_TOOL_NAME_KEYS = ("tool_name", "toolName", "name")
+_TOOL_USE_ID_KEYS = ("tool_use_id", "toolUseId", "id")
+_INPUT_KEYS = ("input", "arguments", "args")
+_IS_ERROR_KEYS = ("is_error", "isError")
+
+# Message type flags, see classify_type().
+MSG_DELTA = 1
+MSG_TOOL = 2
+MSG_RESULT = 4
+MSG_ERROR = 8
+MSG_ASSISTANT = 16
+
+
+def first_of(message: Dict[str, Any], keys: Tuple[str, ...], default: Any = None) -> Any:
+    """Return the first truthy value among `keys`, like an `a or b or c` chain."""
+    for key in keys:
+        value = message.get(key)
+        if value:
+            return value
+    return default
 
 
 def lower_type(message: Dict[str, Any]) -> str:
-    return str(message.get("type") or message.get("kind") or message.get("event") or "").lower()
+    return str(first_of(message, _TYPE_KEYS, "")).lower()
+
+
+@functools.lru_cache(maxsize=256)
+def classify_type(msg_type: str) -> int:
+    flags = 0
+    if "delta" in msg_type or "stream" in msg_type:
+        flags |= MSG_DELTA
+    if "tool" in msg_type:
+        flags |= MSG_TOOL
+    if "result" in msg_type:
+        flags |= MSG_RESULT
+    if "error" in msg_type:
+        flags |= MSG_ERROR
+    if "assistant" in msg_type or "message" in msg_type:
+        flags |= MSG_ASSISTANT
+    return flags
 
 
 async def maybe_await(value: Any) -> Any:
@@ -214,29 +390,43 @@ async def to_async_iterable(value: Any):
     yield resolved
 
 
+def iterate_direct(value: Any) -> Any:
+    return value
+
+
+def pick_iterator(fn: Any) -> Callable[[Any], Any]:
+    """Choose how to iterate what `fn` returns.
+
+    Async generator functions already return an async iterator, so skip the
+    generic to_async_iterable() wrapper for them; anything else keeps it.
+    """
+    return iterate_direct if inspect.isasyncgenfunction(fn) else to_async_iterable
+
+
 def emit_message(ctx: Dict[str, Any], raw: Any, passthrough: bool = False) -> None:
     if passthrough:
-        message = as_object(raw)
-        text = message.get("text") or message.get("delta") or message.get("content") or ""
+        message = raw if isinstance(raw, dict) else {}
         kind = "assistant_delta"
-        payload: Dict[str, Any] = {"text": str(text)}
-        msg_type = lower_type(message)
+        payload: Optional[Dict[str, Any]] = None
+        flags = classify_type(lower_type(message))
         if "usage" in message:
             kind = "usage"
             payload = {"usage": message.get("usage")}
-        elif "error" in msg_type:
+        elif flags & MSG_ERROR:
             kind = "error"
             payload = {"message": safe_string(message.get("error") or message.get("message"))}
-        elif "tool" in msg_type:
-            tool_name = str(message.get("tool_name") or message.get("toolName") or message.get("name") or "unknown_tool")
-            tool_use_id = message.get("tool_use_id") or message.get("toolUseId") or message.get("id")
-            if "result" in msg_type or "output" in message or "result" in message:
+        elif flags & MSG_TOOL:
+            tool_name = first_of(message, _TOOL_NAME_KEYS, "unknown_tool")
+            if type(tool_name) is not str:
+                tool_name = str(tool_name)
+            tool_use_id = first_of(message, _TOOL_USE_ID_KEYS)
+            if flags & MSG_RESULT or "output" in message or "result" in message:
                 kind = "tool_result"
                 payload = {
                     "tool_name": tool_name,
                     "tool_use_id": tool_use_id,
                     "output": message.get("output") if "output" in message else message.get("result"),
-                    "is_error": as_bool(message.get("is_error") or message.get("isError")),
+                    "is_error": as_bool(first_of(message, _IS_ERROR_KEYS)),
                 }
             else:
                 kind = "tool_call"
@@ -244,53 +434,61 @@ def emit_message(ctx: Dict[str, Any], raw: Any, passthrough: bool = False) -> No
                     "tool_name": tool_name,
                     "tool_use_id": tool_use_id,
                     "parent_tool_use_id": None,
-                    "input": message.get("input") or message.get("arguments") or message.get("args") or {},
+                    "input": first_of(message, _INPUT_KEYS, {}),
                 }
-        elif "assistant" in msg_type or "message" in msg_type:
+        elif flags & MSG_ASSISTANT:
             kind = "assistant_message"
-            payload = {"text": str(text)}
+        if payload is None:
+            text = message.get("text") or message.get("delta") or message.get("content") or ""
+            if type(text) is not str:
+                text = str(text)
+            payload = {"text": text}
         ctx["emit"]({"type": kind, **payload}, raw_message=raw)
         return
 
-    message = as_object(raw)
+    message = raw if isinstance(raw, dict) else {}
     if not message:
         return
-    msg_type = lower_type(message)
+    flags = classify_type(lower_type(message))
     text = message.get("text") or message.get("delta") or (message.get("content") if isinstance(message.get("content"), str) else "")
     if text:
-        if "delta" in msg_type or "stream" in msg_type:
-            ctx["state"]["last_assistant"] += str(text)
+        if type(text) is not str:
+            text = str(text)
+        if flags & MSG_DELTA:
+            ctx["state"]["last_assistant"] += text
             ctx["state"]["saw_delta"] = True
-            ctx["emit"]({"type": "assistant_delta", "text": str(text)})
+            ctx["emit_delta"](text)
         else:
-            ctx["state"]["last_assistant"] = str(text)
+            ctx["state"]["last_assistant"] = text
             ctx["state"]["saw_message"] = True
-            ctx["emit"]({"type": "assistant_message", "text": str(text)})
+            ctx["emit"]({"type": "assistant_message", "text": text})
 
-    tool_name = message.get("tool_name") or message.get("toolName") or message.get("name")
+    tool_name = first_of(message, _TOOL_NAME_KEYS)
     if tool_name:
-        tool_use_id = message.get("tool_use_id") or message.get("toolUseId") or message.get("id")
-        if "result" in msg_type or "output" in message or "result" in message:
+        if type(tool_name) is not str:
+            tool_name = str(tool_name)
+        tool_use_id = first_of(message, _TOOL_USE_ID_KEYS)
+        if flags & MSG_RESULT or "output" in message or "result" in message:
             ctx["emit"](
                 {
                     "type": "tool_result",
-                    "tool_name": str(tool_name),
+                    "tool_name": tool_name,
                     "tool_use_id": tool_use_id,
                     "output": message.get("output") if "output" in message else message.get("result"),
-                    "is_error": as_bool(message.get("is_error") or message.get("isError")),
+                    "is_error": as_bool(first_of(message, _IS_ERROR_KEYS)),
                 }
             )
         else:
             ctx["emit"](
                 {
                     "type": "tool_call",
-                    "tool_name": str(tool_name),
+                    "tool_name": tool_name,
                     "tool_use_id": tool_use_id,
                     "parent_tool_use_id": None,
-                    "input": message.get("input") or message.get("arguments") or message.get("args") or {},
+                    "input": first_of(message, _INPUT_KEYS, {}),
                 }
             )
-    if "error" in msg_type:
+    if flags & MSG_ERROR:
         ctx["emit"]({"type": "error", "message": safe_string(message.get("error") or message.get("message"))})
 
 
@@ -321,6 +519,7 @@ def resolve_sdk() -> Dict[str, Any]:
                 "client_ctor": client_ctor if callable(client_ctor) else None,
                 "create_client": create_client if callable(create_client) else None,
                 "options_ctor": options_ctor if callable(options_ctor) else None,
+                "iterate": pick_iterator(query_fn),
             }
             return cached_sdk
         except Exception as err:  # noqa: BLE001
@@ -342,9 +541,18 @@ async def invoke_query(query_fn: Any, request: Dict[str, Any]) -> Any:
         raise
 
 
+async def await_with_timeout(awaitable: Any, timeout_s: Optional[float]) -> Any:
+    if not timeout_s:
+        return await awaitable
+    if async_timeout is None:
+        return await asyncio.wait_for(awaitable, timeout_s)
+    async with async_timeout(timeout_s):
+        return await awaitable
+
+
 async def run_with_sdk(ctx: Dict[str, Any], work_order: Dict[str, Any], mode: str) -> Dict[str, Any]:
-    request = build_request(work_order, mode)
-    passthrough = mode == "passthrough" and get_passthrough_request(work_order) is not None
+    ns = ctx["ns"]
+    request, passthrough = build_request(work_order, ns, mode)
     try:
         sdk = resolve_sdk()
     except Exception as err:  # noqa: BLE001
@@ -365,8 +573,8 @@ async def run_with_sdk(ctx: Dict[str, Any], work_order: Dict[str, Any], mode: st
             "outcome": "partial",
         }
 
-    abp = get_vendor_namespace(work_order, "abp")
-    claude = get_vendor_namespace(work_order, "claude")
+    abp = ns["abp"]
+    claude = ns["claude"]
     client_mode = as_bool(abp.get("client_mode"), as_bool(claude.get("client_mode"), False))
     client_persist = as_bool(abp.get("client_persist"), as_bool(claude.get("client_persist"), False))
     timeout_ms = abp.get("client_timeout_ms") or abp.get("clientTimeoutMs") or 0
@@ -399,6 +607,9 @@ async def run_with_sdk(ctx: Dict[str, Any], work_order: Dict[str, Any], mode: st
             "outcome": "partial",
         }
 
+    # Connecting and querying can take the whole SDK round-trip; send any
+    # warnings queued above before suspending on them.
+    flush_events()
     state = ctx["state"]
     if client_mode:
         options = as_object(request.get("options"))
@@ -413,10 +624,11 @@ async def run_with_sdk(ctx: Dict[str, Any], work_order: Dict[str, Any], mode: st
                 except Exception:
                     built_options = options
 
-        client_session_key = resolve_client_session_key(work_order, request, abp, claude)
+        client_session_key = resolve_client_session_key(work_order, request, ns)
         use_cached_client = client_persist and client_session_key in cached_clients
         if use_cached_client:
             client = cached_clients[client_session_key]
+            cached_clients.move_to_end(client_session_key)
         elif callable(sdk.get("create_client")):
             client = await maybe_await(sdk["create_client"](built_options))
         else:
@@ -431,12 +643,13 @@ async def run_with_sdk(ctx: Dict[str, Any], work_order: Dict[str, Any], mode: st
             if callable(connect):
                 await maybe_await(connect())
             if client_persist:
+                await evict_cached_clients(CLIENT_CACHE_MAX - 1)
                 cached_clients[client_session_key] = client
 
         try:
             query_call = invoke_query(getattr(client, "query", None), request)
             try:
-                query_result = await asyncio.wait_for(query_call, timeout_s) if timeout_s else await query_call
+                query_result = await await_with_timeout(query_call, timeout_s)
             except asyncio.TimeoutError as timeout_err:
                 interrupt = getattr(client, "interrupt", None) or getattr(client, "cancel", None)
                 if callable(interrupt):
@@ -445,10 +658,16 @@ async def run_with_sdk(ctx: Dict[str, Any], work_order: Dict[str, Any], mode: st
                     f"Claude SDK client query timed out after {int(timeout_s * 1000)}ms"
                 ) from timeout_err
             receive = getattr(client, "receive_response", None) or getattr(client, "receiveResponse", None)
-            source = await maybe_await(receive()) if callable(receive) else query_result
-            async for item in to_async_iterable(source):
+            if callable(receive):
+                source = await maybe_await(receive())
+                iterate = pick_iterator(receive)
+            else:
+                source = query_result
+                iterate = to_async_iterable
+            async for item in iterate(source):
                 collect_usage(state, item)
                 emit_message(ctx, item, passthrough=passthrough)
+                flush_events()
         except Exception:
             if client_persist and client_session_key and cached_clients.get(client_session_key) is client:
                 cached_clients.pop(client_session_key, None)
@@ -463,9 +682,10 @@ async def run_with_sdk(ctx: Dict[str, Any], work_order: Dict[str, Any], mode: st
                     await maybe_await(disconnect())
     else:
         response = await invoke_query(sdk.get("query_fn"), request)
-        async for item in to_async_iterable(response):
+        async for item in sdk["iterate"](response):
             collect_usage(state, item)
             emit_message(ctx, item, passthrough=passthrough)
+            flush_events()
 
     if not passthrough and state["saw_delta"] and not state["saw_message"] and state["last_assistant"]:
         ctx["emit"]({"type": "assistant_message", "text": state["last_assistant"]})
@@ -491,55 +711,100 @@ async def run_with_sdk(ctx: Dict[str, Any], work_order: Dict[str, Any], mode: st
     }
 
 
+def open_trace_file(run_id: str) -> Tuple[str, Any]:
+    # The trace carries prompts and tool I/O: mkstemp creates the file with
+    # O_EXCL and mode 0600 under a unique name, so it is private to this user
+    # and never follows a planted symlink or clobbers another run's trace.
+    safe_id = "".join(c if c.isalnum() or c in "-_" else "_" for c in str(run_id))
+    fd, path = tempfile.mkstemp(prefix=f"abp-{safe_id}-", suffix=".jsonl")
+    return path, os.fdopen(fd, "wb")
+
+
 async def handle_run(msg: Dict[str, Any]) -> None:
     run_id = msg.get("id") or str(uuid.uuid4())
     work_order = as_object(msg.get("work_order"))
-    mode = get_execution_mode(work_order)
+    ns = parse_namespaces(work_order)
+    mode = get_execution_mode(ns)
     started_at = now_iso()
-    trace = []
+    t0 = time.monotonic_ns()
+    trace: List[Dict[str, Any]] = []
+    trace_len = 0
+    trace_mode = TRACE_MODE
+    trace_path: Optional[str] = None
+    trace_file: Any = None
+    if trace_mode == "ref":
+        try:
+            trace_path, trace_file = open_trace_file(run_id)
+        except OSError:
+            trace_mode = "inline"
+
+    def record(event: Dict[str, Any]) -> None:
+        """Add an emitted event to the run trace according to trace_mode."""
+        nonlocal trace_len
+        trace_len += 1
+        if trace_mode == "inline":
+            trace.append(event)
+        elif trace_file is not None:
+            trace_file.write(dumps_line(event))
 
     def emit(event: Dict[str, Any], raw_message: Any = None) -> None:
-        payload = {"ts": now_iso(), **event}
+        # Callers always pass a fresh dict, so stamp it in place.
+        event["ts"] = now_iso()
         if raw_message is not None:
-            payload["ext"] = {"raw_message": raw_message}
-        trace.append(payload)
-        write({"t": "event", "ref_id": run_id, "event": payload})
-
-    emit({"type": "run_started", "message": f"python sidecar starting: {safe_string(work_order.get('task'))}"})
-    emit({"type": "assistant_message", "text": f"Execution mode: {mode}"})
-
-    ctx = {
-        "emit": emit,
-        "state": {
-            "usage_raw": {},
-            "last_assistant": "",
-            "saw_delta": False,
-            "saw_message": False,
-        },
-    }
+            event["ext"] = {"raw_message": raw_message}
+        record(event)
+        write({"t": "event", "ref_id": run_id, "event": event})
+
+    # Deltas dominate streaming output, so their envelope is spliced from a
+    # per-run prefix instead of re-encoding it for every token. Encoding a
+    # null event and cutting it off keeps the bytes identical to write().
+    delta_prefix = dumps_line({"t": "event", "ref_id": run_id, "event": None})[: -len(b"null}\n")]
+
+    def emit_delta(text: str) -> None:
+        event = {"type": "assistant_delta", "text": text, "ts": now_iso()}
+        record(event)
+        write_line(delta_prefix + dumps(event) + b"}\n")
 
-    outcome = "complete"
-    usage_raw: Dict[str, Any] = {}
-    usage: Dict[str, int] = {}
-    stream_equivalent = False
     try:
-        result = await run_with_sdk(ctx, work_order, mode)
-        usage_raw = as_object(result.get("usage_raw"))
-        usage = normalize_usage(usage_raw)
-        outcome = str(result.get("outcome") or "complete")
-        stream_equivalent = bool(result.get("stream_equivalent"))
-    except Exception as err:  # noqa: BLE001
-        outcome = "failed"
-        emit({"type": "error", "message": f"adapter error: {safe_string(err)}"})
+        emit({"type": "run_started", "message": f"python sidecar starting: {safe_string(work_order.get('task'))}"})
+        emit({"type": "assistant_message", "text": f"Execution mode: {mode}"})
+        flush_events()
+
+        ctx = {
+            "emit": emit,
+            "emit_delta": emit_delta,
+            "ns": ns,
+            "state": {
+                "usage_raw": {},
+                "last_assistant": "",
+                "saw_delta": False,
+                "saw_message": False,
+            },
+        }
 
-    emit({"type": "run_completed", "message": f"python sidecar run completed with outcome={outcome}"})
+        outcome = "complete"
+        usage_raw: Dict[str, Any] = {}
+        usage: Dict[str, int] = {}
+        stream_equivalent = False
+        try:
+            result = await run_with_sdk(ctx, work_order, mode)
+            usage_raw = as_object(result.get("usage_raw"))
+            usage = as_object(result.get("usage"))
+            outcome = str(result.get("outcome") or "complete")
+            stream_equivalent = bool(result.get("stream_equivalent"))
+        except Exception as err:  # noqa: BLE001
+            outcome = "failed"
+            emit({"type": "error", "message": f"adapter error: {safe_string(err)}"})
+
+        emit({"type": "run_completed", "message": f"python sidecar run completed with outcome={outcome}"})
+    finally:
+        if trace_file is not None:
+            trace_file.close()
     finished_at = now_iso()
-    duration_ms = max(
-        0,
-        int((datetime.fromisoformat(finished_at.replace("Z", "+00:00")) - datetime.fromisoformat(started_at.replace("Z", "+00:00"))).total_seconds() * 1000),
-    )
+    duration_ms = max(0, (time.monotonic_ns() - t0) // 1_000_000)
 
     receipt: Dict[str, Any] = {
+        **_RECEIPT_BASE,
         "meta": {
             "run_id": run_id,
             "work_order_id": work_order.get("id"),
@@ -548,25 +813,26 @@ async def handle_run(msg: Dict[str, Any]) -> None:
             "finished_at": finished_at,
             "duration_ms": duration_ms,
         },
-        "backend": backend,
-        "capabilities": capabilities,
         "mode": mode,
         "usage_raw": usage_raw,
         "usage": usage,
         "trace": trace,
-        "artifacts": [],
-        "verification": {"git_diff": None, "git_status": None, "harness_ok": True},
         "outcome": outcome,
-        "receipt_sha256": None,
     }
     if mode == "passthrough" and stream_equivalent:
         receipt["stream_equivalent"] = True
+    if trace_mode != "inline":
+        receipt["trace_len"] = trace_len
+    if trace_path is not None:
+        receipt["trace_ref"] = trace_path
     write({"t": "final", "ref_id": run_id, "receipt": receipt})
+    flush_events()
 
 
-async def close_cached_clients() -> None:
-    for key, client in list(cached_clients.items()):
-        cached_clients.pop(key, None)
+async def evict_cached_clients(keep: int) -> None:
+    """Disconnect least recently used cached clients until `keep` remain."""
+    while len(cached_clients) > keep:
+        _, client = cached_clients.popitem(last=False)
         disconnect = getattr(client, "disconnect", None) or getattr(client, "close", None)
         if callable(disconnect):
             try:
@@ -575,26 +841,86 @@ async def close_cached_clients() -> None:
                 pass
 
 
+async def close_cached_clients() -> None:
+    await evict_cached_clients(0)
+
+
+async def read_stdin_line(reader: asyncio.StreamReader) -> bytes:
+    """Read one line like StreamReader.readline().
+
+    A line over the reader's limit is consumed up to and including its
+    newline and reported with ValueError, so the next read starts on the
+    following line instead of the tail of the oversized one.
+    """
+    try:
+        return await reader.readuntil(b"\n")
+    except asyncio.IncompleteReadError as err:
+        return err.partial
+    except asyncio.LimitOverrunError as err:
+        overrun = err
+    while True:
+        await reader.readexactly(overrun.consumed)
+        try:
+            await reader.readuntil(b"\n")
+            break
+        except asyncio.IncompleteReadError:
+            break
+        except asyncio.LimitOverrunError as err:
+            overrun = err
+    raise ValueError(f"input line exceeds {_STDIN_LINE_LIMIT} bytes")
+
+
+async def open_stdin_reader() -> Callable[[], Awaitable[bytes]]:
+    # Only POSIX pipes and sockets go on the event loop. On Windows a stdin
+    # pipe also reports S_IFIFO, but it is a synchronous handle the proactor
+    # cannot read, and that failure only shows up on the first read.
+    # connect_read_pipe also makes the file description non-blocking, so it
+    # is skipped when stdout is the same file (a socketpair, inetd or a
+    # systemd socket) to keep stdout writes blocking.
+    use_reader = False
+    if os.name == "posix":
+        try:
+            st_in = os.fstat(sys.stdin.fileno())
+            st_out = os.fstat(sys.stdout.fileno())
+            is_stream = stat.S_ISFIFO(st_in.st_mode) or stat.S_ISSOCK(st_in.st_mode)
+            same_file = (st_in.st_dev, st_in.st_ino) == (st_out.st_dev, st_out.st_ino)
+            use_reader = is_stream and not same_file
+        except (OSError, ValueError):
+            pass
+    if use_reader:
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(limit=_STDIN_LINE_LIMIT)
+        try:
+            await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        except (NotImplementedError, OSError, ValueError):
+            pass
+        else:
+            return functools.partial(read_stdin_line, reader)
+    # Files, terminals, shared stdio sockets, Windows and loops without
+    # pipe support read on a worker thread.
+    return lambda: asyncio.to_thread(sys.stdin.buffer.readline)
+
+
 async def main() -> None:
-    write(
-        {
-            "t": "hello",
-            "contract_version": CONTRACT_VERSION,
-            "backend": backend,
-            "capabilities": capabilities,
-            "mode": "mapped",
-        }
-    )
+    write_line(_HELLO_LINE)
 
+    readline = await open_stdin_reader()
     while True:
-        line = await asyncio.to_thread(sys.stdin.readline)
-        if line == "":
+        flush_events()
+        try:
+            line = await readline()
+        except ValueError as err:
+            write({"t": "fatal", "ref_id": None, "error": f"invalid input: {safe_string(err)}"})
+            continue
+        if not line:
             break
-        raw = line.strip()
-        if not raw:
+        # Both JSON decoders accept surrounding whitespace; only the line
+        # terminator needs trimming, and blank lines are skipped.
+        raw = line.rstrip(b"\r\n")
+        if not raw or raw.isspace():
             continue
         try:
-            msg = json.loads(raw)
+            msg = loads(raw)
         except Exception as err:  # noqa: BLE001
             write({"t": "fatal", "ref_id": None, "error": f"invalid json: {safe_string(err)}"})
             continue
@@ -619,4 +945,5 @@ if __name__ == "__main__":
         asyncio.run(main())
     except Exception as err:  # noqa: BLE001
         write({"t": "fatal", "ref_id": None, "error": f"python host failed: {safe_string(err)}"})
+        flush_events()
         sys.exit(1)
@@ -0,0 +1,41 @@
+"""Fake Claude SDK module for host.py protocol tests.
+
+Selected with ABP_CLAUDE_SDK_MODULE=fake_claude_sdk (with this directory on
+PYTHONPATH). Client lifecycle calls are logged to stderr as
+``fake_sdk: <call> <client number>`` so tests can check their order.
+"""
+
+import sys
+
+# Deltas with characters that need escaping, to exercise envelope splicing.
+DELTAS = ["plain", 'quote " and \\ backslash', "line\nbreak", "café ☃ \U0001f600", "\x00\x1f"]
+
+
+def log(call, n):
+    sys.stderr.write(f"fake_sdk: {call} {n}\n")
+    sys.stderr.flush()
+
+
+async def query(request):
+    for text in DELTAS:
+        yield {"type": "stream_delta", "text": text}
+
+
+class ClaudeSDKClient:
+    instances = 0
+
+    def __init__(self, options=None):
+        ClaudeSDKClient.instances += 1
+        self.n = ClaudeSDKClient.instances
+
+    async def connect(self):
+        log("connect", self.n)
+
+    async def query(self, request):
+        log("query", self.n)
+
+    async def receive_response(self):
+        yield {"type": "assistant", "text": f"client {self.n}"}
+
+    async def disconnect(self):
+        log("disconnect", self.n)
@@ -6,15 +6,21 @@ and asserts the expected responses appear on stdout.
 
 import json
 import os
+import socket
 import subprocess
 import sys
+import tempfile
+import time
 import uuid
 
-HOST = os.path.join(os.path.dirname(__file__), "..", "host.py")
+from fake_claude_sdk import DELTAS
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+HOST = os.path.join(TEST_DIR, "..", "host.py")
 PYTHON = sys.executable
 
 
-def run_sidecar(envelopes, *, timeout=10):
+def run_sidecar(envelopes, *, timeout=10, env=None):
     """Send a list of JSONL envelopes to the sidecar and collect output."""
     input_data = "\n".join(json.dumps(e) for e in envelopes) + "\n"
     result = subprocess.run(
@@ -23,12 +29,43 @@ def run_sidecar(envelopes, *, timeout=10):
         capture_output=True,
         text=True,
         timeout=timeout,
+        env={**os.environ, **(env or {})},
     )
     lines = [l for l in result.stdout.strip().splitlines() if l.strip()]
     msgs = [json.loads(l) for l in lines]
     return msgs, result.stderr
 
 
+def run_with_fake_sdk(envelopes, *, env=None, path=()):
+    """Run the sidecar against fake_claude_sdk.
+
+    Returns raw stdout bytes and the fake SDK's client call log. Extra
+    `path` entries are put ahead of the test directory on PYTHONPATH.
+    """
+    pythonpath = [*path, TEST_DIR]
+    if os.environ.get("PYTHONPATH"):
+        pythonpath.append(os.environ["PYTHONPATH"])
+    input_data = "\n".join(json.dumps(e) for e in envelopes) + "\n"
+    result = subprocess.run(
+        [PYTHON, HOST],
+        input=input_data.encode("utf-8"),
+        capture_output=True,
+        timeout=10,
+        env={
+            **os.environ,
+            "PYTHONPATH": os.pathsep.join(pythonpath),
+            "ABP_CLAUDE_SDK_MODULE": "fake_claude_sdk",
+            **(env or {}),
+        },
+    )
+    calls = [
+        l[len("fake_sdk: "):]
+        for l in result.stderr.decode("utf-8").splitlines()
+        if l.startswith("fake_sdk: ")
+    ]
+    return result.stdout, calls
+
+
 def make_work_order(**overrides):
     wo = {
         "id": str(uuid.uuid4()),
@@ -114,6 +151,22 @@ def test_invalid_json():
     assert any(m["t"] == "fatal" and "invalid json" in m.get("error", "") for m in msgs)
 
 
+def test_oversized_line_is_skipped():
+    """A line over the stdin limit gets a fatal; later envelopes still work."""
+    oversized = "x" * (64 * 1024 * 1024 + 1)
+    result = subprocess.run(
+        [PYTHON, HOST],
+        input=(oversized + "\n" + json.dumps({"t": "ping", "seq": 7}) + "\n").encode("utf-8"),
+        capture_output=True,
+        timeout=30,
+    )
+    msgs = [json.loads(l) for l in result.stdout.splitlines() if l.strip()]
+    assert result.returncode == 0, result.stderr
+    assert [m["t"] for m in msgs] == ["hello", "fatal", "pong"]
+    assert msgs[1]["ref_id"] is None
+    assert msgs[2]["seq"] == 7
+
+
 def test_ref_id_matches_run_id():
     """All events and final ref_id must match the run envelope id."""
     run_id = str(uuid.uuid4())
@@ -126,6 +179,157 @@ def test_ref_id_matches_run_id():
     assert final["ref_id"] == run_id
 
 
+def test_trace_mode_ref():
+    """ABP_TRACE_MODE=ref spills the trace to a file and references it."""
+    run = make_run()
+    msgs, _ = run_sidecar([run], env={"ABP_TRACE_MODE": "ref"})
+    events = [m for m in msgs if m["t"] == "event"]
+    r = next(m for m in msgs if m["t"] == "final")["receipt"]
+    path = r["trace_ref"]
+    try:
+        assert r["trace"] == []
+        assert r["trace_len"] == len(events)
+        assert r["artifacts"] == []
+        if os.name == "posix":
+            assert os.stat(path).st_mode & 0o777 == 0o600
+        with open(path, encoding="utf-8") as f:
+            spilled = [json.loads(l) for l in f if l.strip()]
+        assert spilled == [ev["event"] for ev in events]
+    finally:
+        os.remove(path)
+
+
+def test_trace_mode_summary():
+    """ABP_TRACE_MODE=summary keeps only the event count in the receipt."""
+    run = make_run()
+    msgs, _ = run_sidecar([run], env={"ABP_TRACE_MODE": "summary"})
+    events = [m for m in msgs if m["t"] == "event"]
+    r = next(m for m in msgs if m["t"] == "final")["receipt"]
+    assert r["trace"] == []
+    assert r["trace_len"] == len(events)
+    assert "trace_ref" not in r
+
+
+def test_import_has_no_side_effects():
+    """Importing host.py must not emit hello or consume stdin."""
+    code = (
+        "import importlib.util, sys\n"
+        f"spec = importlib.util.spec_from_file_location('abp_host', {HOST!r})\n"
+        "spec.loader.exec_module(importlib.util.module_from_spec(spec))\n"
+        "sys.stderr.write(sys.stdin.read())\n"
+    )
+    result = subprocess.run(
+        [PYTHON, "-c", code],
+        input=json.dumps({"t": "ping", "seq": 1}) + "\n",
+        capture_output=True,
+        text=True,
+        timeout=10,
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout == ""
+    assert json.loads(result.stderr) == {"t": "ping", "seq": 1}
+
+
+def test_shared_socket_stdio():
+    """A socket used as both stdin and stdout must keep blocking writes.
+
+    The host is only drained after a delay, so a large event has to block
+    until the reader catches up rather than fail partway through.
+    """
+    if not hasattr(socket, "socketpair") or os.name != "posix":
+        return
+    ours, theirs = socket.socketpair()
+    with ours:
+        with theirs:
+            proc = subprocess.Popen([PYTHON, HOST], stdin=theirs, stdout=theirs)
+        run = make_run(make_work_order(task="x" * (3 * 1024 * 1024)))
+        ours.sendall((json.dumps(run) + "\n").encode("utf-8"))
+        ours.shutdown(socket.SHUT_WR)
+        time.sleep(1.5)
+        chunks = []
+        while True:
+            chunk = ours.recv(1 << 16)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    assert proc.wait(timeout=10) == 0
+    msgs = [json.loads(l) for l in b"".join(chunks).splitlines() if l.strip()]
+    assert msgs[0]["t"] == "hello"
+    assert msgs[-1]["t"] == "final"
+    assert msgs[-1]["ref_id"] == run["id"]
+
+
+def make_client_run(session_key):
+    return make_run(
+        make_work_order(
+            config={
+                "vendor": {
+                    "abp": {
+                        "client_mode": True,
+                        "client_persist": True,
+                        "client_session_key": session_key,
+                    }
+                }
+            }
+        )
+    )
+
+
+def test_client_cache_evicts_lru():
+    """Persistent clients beyond ABP_CLIENT_CACHE_MAX are disconnected, oldest first."""
+    _, calls = run_with_fake_sdk(
+        [make_client_run(k) for k in "ab"], env={"ABP_CLIENT_CACHE_MAX": "1"}
+    )
+    assert calls == ["connect 1", "query 1", "connect 2", "disconnect 1", "query 2", "disconnect 2"]
+
+    # Reusing "a" makes "b" the least recently used, so "c" evicts it.
+    _, calls = run_with_fake_sdk(
+        [make_client_run(k) for k in "abac"], env={"ABP_CLIENT_CACHE_MAX": "2"}
+    )
+    assert calls == [
+        "connect 1", "query 1",
+        "connect 2", "query 2",
+        "query 1",
+        "connect 3", "disconnect 2", "query 3",
+        "disconnect 1", "disconnect 3",
+    ]
+
+    # Unparseable limits fall back to the default, which fits both clients.
+    _, calls = run_with_fake_sdk(
+        [make_client_run(k) for k in "ab"], env={"ABP_CLIENT_CACHE_MAX": "lots"}
+    )
+    assert calls == ["connect 1", "query 1", "connect 2", "query 2", "disconnect 1", "disconnect 2"]
+
+
+def test_delta_envelopes_match_encoder():
+    """Spliced assistant_delta envelopes are byte-identical to a full encode."""
+    run = make_run()
+    run["id"] = 'run "1" \\ caf\u00e9'
+    encoders = []
+    try:
+        import orjson
+
+        opts = orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS
+        encoders.append(((), lambda obj: orjson.dumps(obj, option=opts)))
+    except ImportError:
+        pass
+    with tempfile.TemporaryDirectory() as no_orjson:
+        # Shadow orjson so the sidecar uses its stdlib json fallback.
+        with open(os.path.join(no_orjson, "orjson.py"), "w", encoding="utf-8") as f:
+            f.write("raise ImportError('orjson disabled for this test')\n")
+        encoders.append(((no_orjson,), lambda obj: (json.dumps(obj) + "\n").encode("utf-8")))
+        for path, encode in encoders:
+            stdout, _ = run_with_fake_sdk([run], path=path)
+            deltas = []
+            for line in stdout.splitlines(keepends=True):
+                msg = json.loads(line)
+                if msg["t"] == "event" and msg["event"]["type"] == "assistant_delta":
+                    assert encode(msg) == line, line
+                    assert msg["ref_id"] == run["id"]
+                    deltas.append(msg["event"]["text"])
+            assert deltas == DELTAS
+
+
 if __name__ == "__main__":
     tests = [
         test_hello_is_first,
@@ -134,7 +338,14 @@ if __name__ == "__main__":
         test_ping_pong,
         test_cancel_ignored,
         test_invalid_json,
+        test_oversized_line_is_skipped,
         test_ref_id_matches_run_id,
+        test_trace_mode_ref,
+        test_trace_mode_summary,
+        test_import_has_no_side_effects,
+        test_shared_socket_stdio,
+        test_client_cache_evicts_lru,
+        test_delta_envelopes_match_encoder,
     ]
     passed = 0
     failed = 0